@@ -1,11 +1,26 @@
 # ai_parser.py
-import os, requests, json, re
+import os, requests, json, re, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from metrics import timed, LLM_TOKENS, LLM_MODEL_SECONDS
+from currency import (parse_amount, normalize_amounts, detect_currency, normalize_code, strip_symbols,
+                      DEFAULT_CURRENCY, DOLLAR_CURRENCY)
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL")
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", 60))
+
+# Multi-model routing (see ModelRouter). OPENROUTER_MODELS is a comma-separated list
+# tried in order; it defaults to the single OPENROUTER_MODEL.
+OPENROUTER_MODELS = [m.strip() for m in os.getenv("OPENROUTER_MODELS", "").split(",") if m.strip()] or [OPENROUTER_MODEL]
+OPENROUTER_STRATEGY = os.getenv("OPENROUTER_STRATEGY", "fallback")  # "fallback" or "race"
+OPENROUTER_SMALL_MODEL = os.getenv("OPENROUTER_SMALL_MODEL")
+SMALL_RECEIPT_LINES = int(os.getenv("SMALL_RECEIPT_LINES", 15))
 
 PROMPT_TEMPLATE = """
 You are a data extraction model for restaurant receipts.
@@ -33,23 +48,250 @@ matching the structure below. You MUST extract each menu item and its price corr
 {ocr}
 """
 
-def call_openrouter(prompt: str) -> str:
+class LLMCancelled(Exception):
+    """Raised inside a losing race attempt once another model has already answered."""
+
+
+def call_openrouter(prompt: str, model: str = None, cancel_event: threading.Event = None) -> str:
+    """
+    Send one chat completion to OpenRouter and return the message content.
+    With a cancel_event the response is streamed and the connection dropped as soon as
+    the event is set, which stops generation (and billing) upstream.
+    """
+    model = model or OPENROUTER_MODEL
+    if cancel_event is not None and cancel_event.is_set():
+        raise LLMCancelled(model)
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "X-Title": "AI Receipt Splitter Bot",
         "Content-Type": "application/json",
     }
     payload = {
-        "model": OPENROUTER_MODEL,
+        "model": model,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.0,
         "max_tokens": 800,
     }
-    resp = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-    if resp.status_code != 200:
-        raise Exception(f"OpenRouter API error {resp.status_code}: {resp.text}")
-    data = resp.json()
-    return data["choices"][0]["message"]["content"]
+    stream = cancel_event is not None
+    if stream:
+        payload["stream"] = True
+        payload["usage"] = {"include": True}
+    with timed("llm", cancelled=LLMCancelled):
+        resp = requests.post(OPENROUTER_URL, headers=headers, json=payload, timeout=OPENROUTER_TIMEOUT, stream=stream)
+        if resp.status_code != 200:
+            raise Exception(f"OpenRouter API error {resp.status_code}: {resp.text}")
+        if stream:
+            content, usage = _read_stream(resp, cancel_event)
+        else:
+            data = resp.json()
+            content, usage = data["choices"][0]["message"]["content"], data.get("usage") or {}
+    for kind in ("prompt", "completion"):
+        if usage.get(f"{kind}_tokens"):
+            LLM_TOKENS.inc(usage[f"{kind}_tokens"], model=model, kind=kind)
+    return content
+
+
+def _read_stream(resp, cancel_event: threading.Event):
+    parts, usage = [], {}
+    try:
+        for line in resp.iter_lines(decode_unicode=True):
+            if cancel_event.is_set():
+                raise LLMCancelled()
+            # skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+            if not line or not line.startswith("data: "):
+                continue
+            if line == "data: [DONE]":
+                break
+            chunk = json.loads(line[6:])
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices") or []:
+                parts.append((choice.get("delta") or {}).get("content") or "")
+    finally:
+        resp.close()
+    return "".join(parts), usage
+
+
+def _extract_json(raw: str):
+    try:
+        return json.loads(raw)
+    except Exception:
+        m = re.search(r"\{.*\}", raw or "", re.S)
+        if m:
+            try:
+                return json.loads(m.group(0))
+            except Exception:
+                pass
+    return None
+
+
+def is_valid_receipt(parsed) -> bool:
+    """Minimal schema check used to decide whether a model's answer can be accepted."""
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("items"), list) or not parsed["items"]:
+        return False
+    return all(
+        isinstance(it, dict) and it.get("name") and
+        (it.get("total_price") is not None or it.get("unit_price") is not None)
+        for it in parsed["items"]
+    )
+
+
+class ModelRouter:
+    """
+    Chooses which OpenRouter model(s) answer a prompt and tracks per-model latency.
+
+    strategy="fallback": try models in configured order until one returns a valid receipt.
+    strategy="race": run the two fastest recent models at once, keep the first valid answer,
+                     cancel the other, then fall back through the remaining models.
+    small_model: receipts with at most `small_lines` OCR lines go to this model first.
+    """
+
+    def __init__(self, models: list, strategy: str = "fallback", small_model: str = None,
+                 small_lines: int = 15, alpha: float = 0.3, race_workers: int = 8):
+        if strategy not in ("fallback", "race"):
+            raise ValueError(f"unknown routing strategy: {strategy}")
+        self.models = list(models)
+        self.strategy = strategy
+        self.small_model = small_model
+        self.small_lines = small_lines
+        self.alpha = alpha
+        # model -> {"ewma": seconds|None, "failures": consecutive failures, "attempts": calls started,
+        #           "measured": ewma includes a completed call, "losses": races lost (cancelled)}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._race_workers = race_workers
+        self._pool = None
+
+    def _entry(self, model: str) -> dict:
+        return self._stats.setdefault(model, {"ewma": None, "failures": 0, "attempts": 0,
+                                              "measured": False, "losses": 0})
+
+    def record(self, model: str, seconds: float, outcome: str = "ok"):
+        """
+        outcome "ok"/"error" is a completed call; "cancelled" means the model lost a race,
+        so `seconds` is only a lower bound on its latency.
+        """
+        LLM_MODEL_SECONDS.observe(seconds, model=model, outcome=outcome)
+        with self._lock:
+            st = self._entry(model)
+            if outcome == "error":
+                st["failures"] += 1
+                return
+            st["ewma"] = seconds if st["ewma"] is None else self.alpha * seconds + (1 - self.alpha) * st["ewma"]
+            if outcome == "cancelled":
+                st["losses"] += 1
+            else:
+                st["measured"] = True
+                st["failures"] = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {m: dict(st) for m, st in self._stats.items()}
+
+    def ranked(self, models: list) -> list:
+        """
+        Healthy models first, fastest first. A model never tried yet ranks as fastest so it
+        gets tried once; models only known to have lost races come after every measured
+        model, fewest losses first, so they take turns in the second race slot.
+        """
+        stats = self.stats()
+
+        def key(m):
+            st = stats.get(m) or {}
+            if st.get("measured") or not (st.get("attempts") or st.get("losses")):
+                return (st.get("failures", 0) > 0, 0, 0, st.get("ewma") or 0.0)
+            return (st.get("failures", 0) > 0, 1, st.get("losses", 0), st.get("ewma") or float("inf"))
+
+        return sorted(models, key=key)
+
+    def _call(self, model: str, prompt: str, cancel_event: threading.Event = None, race: dict = None):
+        with self._lock:
+            self._entry(model)["attempts"] += 1
+        start = time.perf_counter()
+        try:
+            raw = call_openrouter(prompt, model=model, cancel_event=cancel_event)
+        except LLMCancelled:
+            # the loser was at least as slow as the winner; without this it would never get a latency
+            self.record(model, max(time.perf_counter() - start, (race or {}).get("winner", 0.0)), "cancelled")
+            raise
+        except Exception:
+            self.record(model, time.perf_counter() - start, "error")
+            raise
+        valid = is_valid_receipt(_extract_json(raw))
+        seconds = time.perf_counter() - start
+        if valid and race is not None:
+            race.setdefault("winner", seconds)
+        self.record(model, seconds, "ok" if valid else "error")
+        if not valid:
+            log.warning("model %s returned an invalid receipt", model)
+        return raw, valid
+
+    def _race(self, models: list, prompt: str, last: dict):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self._race_workers, thread_name_prefix="llm-race")
+        cancel = threading.Event()
+        race = {}
+        futures = [self._pool.submit(self._call, m, prompt, cancel, race) for m in models]
+        try:
+            for fut in as_completed(futures):
+                try:
+                    raw, valid = fut.result()
+                except Exception as e:
+                    last["error"] = e
+                    continue
+                if valid:
+                    return raw
+                last["raw"] = raw
+        finally:
+            cancel.set()
+            for model, fut in zip(models, futures):
+                if fut.cancel():  # never started: lost to the winner without a call
+                    self.record(model, race.get("winner", 0.0), "cancelled")
+        return None
+
+    def complete(self, prompt: str, ocr_text: str = "") -> str:
+        """
+        Return the raw response of the first model whose answer passes is_valid_receipt.
+        If none does, the last raw answer is returned (so post-processing can degrade as
+        before); if every model errored, the last error is raised.
+        """
+        chain = list(self.models)
+        last = {}
+
+        def attempt(model):
+            try:
+                raw, valid = self._call(model, prompt)
+            except Exception as e:
+                last["error"] = e
+                return None
+            last["raw"] = raw
+            return raw if valid else None
+
+        if self.small_model and len(ocr_text.splitlines()) <= self.small_lines:
+            raw = attempt(self.small_model)
+            if raw is not None:
+                return raw
+            chain = [m for m in chain if m != self.small_model]
+
+        if self.strategy == "race" and len(chain) > 1:
+            racers = self.ranked(chain)[:2]
+            raw = self._race(racers, prompt, last)
+            if raw is not None:
+                return raw
+            chain = [m for m in chain if m not in racers]
+
+        for model in chain:
+            raw = attempt(model)
+            if raw is not None:
+                return raw
+
+        if "raw" in last:
+            return last["raw"]
+        raise last.get("error") or Exception("no OpenRouter model configured")
+
+
+ROUTER = ModelRouter(OPENROUTER_MODELS, OPENROUTER_STRATEGY, OPENROUTER_SMALL_MODEL, SMALL_RECEIPT_LINES)
 
 def to_float(x):
     try:
@@ -57,12 +299,7 @@ def to_float(x):
             return 0.0
         if isinstance(x, (int, float)):
             return float(x)
-        s = str(x).strip()
-        s = s.replace('−', '-').replace('—', '-').replace('–', '-')
-        s = s.replace(',', '.')
-        s = s.replace('$', '').replace('RM', '').strip()
-        m = re.search(r'-?[0-9]+(?:\.[0-9]{1,2})?', s)
-        return float(m.group(0)) if m else 0.0
+        return parse_amount(x)
     except Exception:
         return 0.0
 
@@ -70,7 +307,7 @@ def detect_item_discounts(ocr_text: str, parsed_items: list):
     """
     Detect and apply discounts from OCR text, attaching each to its respective item.
     Returns (parsed_items_modified, detected_discounts_list).
-    Each detected discount item is a dict: {"description": str, "amount": float, "item": str}
+    Each detected discount item is a dict: {"description": str, "amount": float, "item": str, "applied": True}
     """
     lines = [ln.rstrip() for ln in ocr_text.splitlines() if ln.strip()]
     item_line_re = re.compile(
@@ -168,36 +405,38 @@ def detect_item_discounts(ocr_text: str, parsed_items: list):
         detected_discounts.append({
             "description": re.sub(r'\s+', ' ', line),
             "amount": round(disc_amt, 2),
-            "item": target.get("name")
+            "item": target.get("name"),
+            "applied": True,
         })
 
-        print(f"[DEBUG] Applied discount ${disc_amt:.2f} to item '{target.get('name')}' from line: '{line}'")
-
-    if detected_discounts:
-        print("\n[DEBUG] Detected item-linked discounts:")
-        for d in detected_discounts:
-            print(f"  - {d['item']}: {d['description']} (${d['amount']})")
+        log.debug("applied discount %.2f to item %r from line %r", disc_amt, target.get("name"), line)
 
     return parsed_items, detected_discounts
 
 
 def parse_receipt_text(ocr_text: str, participants: list = None) -> dict:
     participants = participants or []
+    # Resolve number format and currency once per receipt (amounts become plain dot-decimal)
+    # bare "$" alone is ambiguous, so it only decides the currency if the model names none
+    currency = detect_currency(ocr_text, bare_dollar=False)
+    ocr_text, _ = normalize_amounts(ocr_text, currency)
     prompt = PROMPT_TEMPLATE.format(ocr=ocr_text)
-    raw = call_openrouter(prompt)
+    raw = ROUTER.complete(prompt, ocr_text)
+    log.debug("raw AI response: %s", raw)
 
-    print("\n--- RAW AI RESPONSE START ---")
-    print(raw)
-    print("--- RAW AI RESPONSE END ---\n")
+    with timed("postprocess"):
+        # the line heuristics already understand "$"; other symbols ("RM", "S$", "€") are stripped
+        heuristics_text = ocr_text if currency in (None, DOLLAR_CURRENCY) else strip_symbols(ocr_text)
+        parsed = _postprocess(raw, heuristics_text)
+        parsed["currency"] = (currency or normalize_code(parsed.get("currency"))
+                              or (DOLLAR_CURRENCY if "$" in ocr_text else DEFAULT_CURRENCY))
+        return parsed
 
-    try:
-        parsed = json.loads(raw)
-    except Exception:
-        m = re.search(r"\{.*\}", raw, re.S)
-        if m:
-            parsed = json.loads(m.group(0))
-        else:
-            parsed = {"items": [], "taxes": [], "service_charge": None, "discounts": [], "currency": None}
+
+def _postprocess(raw: str, ocr_text: str) -> dict:
+    parsed = _extract_json(raw)
+    if not isinstance(parsed, dict):
+        parsed = {"items": [], "taxes": [], "service_charge": None, "discounts": [], "currency": None}
 
     # --- Normalize: move any LLM-returned discount-like items into parsed["discounts"] ---
     cleaned_items = []
@@ -242,6 +481,11 @@ def parse_receipt_text(ocr_text: str, participants: list = None) -> dict:
         )
         for d in parsed["discounts"]
     )
+    # the model usually reports the same discounts the OCR lines just applied
+    applied = {((dd.get("item") or "").strip().lower(), round(to_float(dd.get("amount")), 2)) for dd in detected_discounts}
+    for d in parsed["discounts"]:
+        if ((d.get("item") or "").strip().lower(), round(to_float(d.get("amount")), 2)) in applied:
+            d["applied"] = True
     for dd in detected_discounts:
         key = (
             (dd.get("description") or "").strip().lower(),
@@ -257,8 +501,8 @@ def parse_receipt_text(ocr_text: str, participants: list = None) -> dict:
         lines = [ln.strip().replace('—', '-').replace('–', '-') for ln in ocr_text.splitlines() if ln.strip()]
         used_lines = set()
         for d in parsed.get("discounts", []):
-            # skip discounts already tied to an item (these were applied earlier)
-            if d.get("item"):
+            # skip discounts already applied or tied to a specific item
+            if d.get("applied") or d.get("item"):
                 continue
 
             desc = (d.get("description") or "").strip().lower()
@@ -302,6 +546,7 @@ def parse_receipt_text(ocr_text: str, participants: list = None) -> dict:
                 orig_total = to_float(target.get("total_price", 0))
                 target["discount"] = {"type": "flat", "amount": round(amt, 2), "description": desc}
                 target["total_price"] = round(orig_total - amt, 2)
+                d["applied"] = True
 
     # --- AFTER ALL LINE-LEVEL DISCOUNTS APPLIED: expand into per-unit items for the bot -->
     expanded = []
@@ -341,30 +586,17 @@ def parse_receipt_text(ocr_text: str, participants: list = None) -> dict:
     # --- Final computed total (derived from adjusted line totals) ---
     subtotal = sum(to_float(it.get("total_price", 0)) for it in parsed.get("items_expanded", []))
     # If you want subtotal at line-level instead use parsed["items"] before expansion
-    service_amt = to_float(parsed.get("service_charge", {}).get("amount", 0))
+    service_amt = to_float((parsed.get("service_charge") or {}).get("amount", 0))
     tax_amt = sum(to_float(t.get("amount")) for t in parsed.get("taxes", []))
-    parsed["computed_total"] = round(subtotal + service_amt + tax_amt, 2)
-
-    # --- DEBUG: Final item prices after all discounts applied ---
-    print("\n[DEBUG] Final item totals after discounts:")
-    for item in parsed.get("items", []):
-        name = item.get("name", "UNKNOWN")
-        qty = item.get("qty", 1)
-        unit = item.get("unit_price", 0.0)
-        total = item.get("total_price", 0.0)
-        print(f"  - {name}: qty={qty}, unit={unit:.2f}, total={total:.2f}")
-
-    # Also, show subtotal, taxes, and total summary if available
-    subtotal_display = sum(i.get("total_price", 0) for i in parsed.get("items", []))
-    tax_total = sum(t.get("amount", 0) for t in parsed.get("taxes", []))
-    service = parsed.get("service_charge", {}).get("amount") or 0
-    grand_total = subtotal_display + tax_total + service
-
-    print(f"\n[DEBUG] Receipt summary:")
-    print(f"  Subtotal after discounts: ${subtotal_display:.2f}")
-    print(f"  Tax total: ${tax_total:.2f}")
-    print(f"  Service charge: ${service:.2f}")
-    print(f"  Grand total (calculated): ${grand_total:.2f}")
-    print("-" * 50)
+    # discounts that could not be tied to an item line still come off the bill
+    unapplied = sum(to_float(d.get("amount")) for d in parsed.get("discounts", []) if not d.get("applied"))
+    parsed["computed_total"] = round(subtotal + service_amt + tax_amt - unapplied, 2)
+
+    if log.isEnabledFor(logging.DEBUG):
+        for item in parsed.get("items", []):
+            log.debug("final item %r: qty=%s unit=%.2f total=%.2f", item.get("name", "UNKNOWN"),
+                      item.get("qty", 1), item.get("unit_price", 0.0), item.get("total_price", 0.0))
+        log.debug("receipt summary: subtotal=%.2f taxes=%.2f service=%.2f computed_total=%.2f",
+                  subtotal, tax_amt, service_amt, parsed["computed_total"])
 
     return parsed
@@ -1,47 +1,178 @@
 # app.py
-import os
-from flask import Flask, request, jsonify
+import os, json, uuid, threading, logging
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify
 from dotenv import load_dotenv
+import ocr
 from ocr import extract_text_from_image
 from ai_parser import parse_receipt_text
 from split_calc import compute_splits
+from currency import normalize_code
+from metrics import timed, render_metrics, CONTENT_TYPE
 
 load_dotenv()
 
 app = Flask(__name__)
 
+# Parsed receipts kept in memory so splits can be recomputed without re-running OCR + LLM.
+# Oldest entries are evicted first once the cap is reached.
+RECEIPT_CACHE_SIZE = int(os.getenv('RECEIPT_CACHE_SIZE', 256))
+_receipts = OrderedDict()
+_receipts_lock = threading.Lock()
+
+
+def store_receipt(parsed: dict) -> str:
+    receipt_id = uuid.uuid4().hex
+    with _receipts_lock:
+        _receipts[receipt_id] = parsed
+        while len(_receipts) > RECEIPT_CACHE_SIZE:
+            _receipts.popitem(last=False)
+    return receipt_id
+
+
+def get_receipt(receipt_id: str):
+    with _receipts_lock:
+        parsed = _receipts.get(receipt_id)
+        if parsed is not None:
+            _receipts.move_to_end(receipt_id)
+        return parsed
+
+
+def apply_assignments(parsed: dict, assignments: dict) -> dict:
+    """
+    Return a shallow copy of `parsed` whose items carry `assigned_to` lists built from
+    assignments ({"Alice": [0, 2], "Bob": [2]} -> item index per person).
+    The cached receipt itself is never mutated.
+    """
+    items = [dict(it) for it in parsed.get("items", [])]
+    for it in items:
+        it.pop("assigned_to", None)
+    for person, indices in (assignments or {}).items():
+        for i in indices:
+            if int(i) < 0:
+                raise IndexError(i)
+            items[int(i)].setdefault("assigned_to", []).append(person)
+    result = dict(parsed)
+    result["items"] = items
+    return result
+
+
 @app.route('/health')
 def health():
     return 'ok'
 
+@app.route('/health/ocr')
+def health_ocr():
+    status = ocr.backend_health()
+    ok = all(s.get('ok') for s in status.values())
+    return jsonify(status), (200 if ok else 503)
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype=CONTENT_TYPE)
+
 @app.route('/process', methods=['POST'])
 def process():
-    # expects multipart form-data with 'image' file and optional 'participants' json list
+    # expects multipart form-data with 'image' file, optional 'participants' json list
+    # and optional 'ocr_backend' name (see ocr.available_backends())
     if 'image' not in request.files:
         return jsonify({'error': 'image missing'}), 400
     f = request.files['image']
+    backend = request.form.get('ocr_backend') or None
+    if backend and backend not in ocr.available_backends():
+        return jsonify({'error': f'unknown ocr_backend: {backend}'}), 400
     participants = request.form.get('participants')
     try:
-        participants = [] if not participants else eval(participants)
+        participants = [] if not participants else json.loads(participants)
     except Exception:
         participants = []
 
     # save temporarily
     import tempfile
     path = os.path.join(tempfile.gettempdir(), f.filename)
-    f.save(path)
+    with timed('download'):
+        f.save(path)
 
-    ocr_text = extract_text_from_image(path)
+    try:
+        ocr_text = extract_text_from_image(path, backend)
+    except ocr.BackendUnavailable as e:
+        return jsonify({'error': str(e)}), 503
 
     # AI parse
     parsed = parse_receipt_text(ocr_text, participants)
+    receipt_id = store_receipt(parsed)
 
     # compute splits
-    splits = compute_splits(parsed, participants)
+    with timed('split'):
+        splits = compute_splits(parsed, participants)
+
+    return jsonify({'receipt_id': receipt_id, 'ocr_text': ocr_text, 'parsed': parsed, 'splits': splits})
+
+def _settle(receipt_ids: list, assignments_by_receipt: dict, body: dict):
+    """Shared body of the split endpoints; returns (json payload, status code)."""
+    participants = body.get('participants') or []
+    mode = body.get('mode') or ('item' if any(assignments_by_receipt.values()) else 'even')
+    base_currency = body.get('base_currency')
+    if base_currency:
+        base_currency = normalize_code(base_currency)
+        if base_currency is None:
+            return {'error': f"unknown base_currency: {body['base_currency']}"}, 400
 
-    return jsonify({'ocr_text': ocr_text, 'parsed': parsed, 'splits': splits})
+    if mode not in ('even', 'item'):
+        return {'error': f'unknown mode: {mode}'}, 400
+    if not isinstance(participants, list) or not all(isinstance(a, dict) for a in assignments_by_receipt.values()):
+        return {'error': 'participants must be a list and assignments an object'}, 400
+
+    receipts = []
+    for receipt_id in receipt_ids:
+        parsed = get_receipt(receipt_id)
+        if parsed is None:
+            return {'error': f'receipt not found: {receipt_id}'}, 404
+        assignments = assignments_by_receipt.get(receipt_id) or {}
+        unknown = [p for p in assignments if p not in participants]
+        if unknown:
+            return {'error': f'assignments for unknown participants: {unknown}'}, 400
+        try:
+            receipts.append(apply_assignments(parsed, assignments) if mode == 'item' else parsed)
+        except (IndexError, ValueError, TypeError):
+            return {'error': 'assignments must map names to valid item indices'}, 400
+
+    try:
+        with timed('split'):
+            splits = compute_splits(receipts if len(receipts) > 1 else receipts[0], participants,
+                                    mode=mode, base_currency=base_currency)
+    except ValueError as e:  # no exchange rate for one of the receipt currencies
+        return {'error': str(e)}, 400
+    currency = base_currency or next((r.get('currency') for r in receipts if r.get('currency')), None)
+    return {'mode': mode, 'currency': currency, 'splits': splits}, 200
+
+@app.route('/receipts/<receipt_id>/split', methods=['POST'])
+def split(receipt_id):
+    # expects json body: {"participants": [...], "assignments": {name: [item index, ...]},
+    #                     "mode": "even"|"item", "base_currency": optional ISO code}
+    body = request.get_json(silent=True) or {}
+    payload, status = _settle([receipt_id], {receipt_id: body.get('assignments') or {}}, body)
+    if status == 200:
+        payload['receipt_id'] = receipt_id
+    return jsonify(payload), status
+
+@app.route('/trips/split', methods=['POST'])
+def split_trip():
+    # expects json body: {"receipt_ids": [...], "participants": [...], "mode": "even"|"item",
+    #                     "assignments": {receipt_id: {name: [item index, ...]}}, "base_currency": optional}
+    body = request.get_json(silent=True) or {}
+    receipt_ids = body.get('receipt_ids') or []
+    assignments = body.get('assignments') or {}
+    if not isinstance(receipt_ids, list) or not receipt_ids or not isinstance(assignments, dict):
+        return jsonify({'error': 'receipt_ids must be a non-empty list'}), 400
+    payload, status = _settle(receipt_ids, {rid: assignments.get(rid) or {} for rid in receipt_ids}, body)
+    if status == 200:
+        payload['receipt_ids'] = receipt_ids
+    return jsonify(payload), status
 
 if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    ocr.warm_up()
     port = int(os.getenv('FLASK_PORT', 5000))
     app.run(host='0.0.0.0', port=port)
-
@@ -0,0 +1,163 @@
+# bench.py
+"""
+End-to-end benchmark suite.
+
+    python bench.py                      # run and compare against bench_baseline.json
+    python bench.py --save               # run and overwrite the baseline
+    python bench.py --threshold 0.5      # flag regressions slower than baseline by >50%
+
+Receipts are rendered synthetically (receipt_gen.py) so every run has ground truth.
+The LLM is replaced by a canned stub returning the ground-truth JSON. /process uses
+real Tesseract OCR when the binary is installed, otherwise (or with --ocr stub) the
+local "fake" OCR backend (enabled for the run) returns the ground-truth text.
+"""
+import argparse, copy, io, json, os, shutil, statistics, sys, time
+from unittest import mock
+
+import ai_parser
+import app as app_module
+import ocr
+from ocr import clean_ocr_text
+from receipt_gen import generate_receipt, render_receipt
+from split_calc import compute_splits
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# (label, generate_receipt kwargs, render_receipt kwargs)
+SCENARIOS = [
+    ("small", dict(n_items=3, n_discounts=0, service_pct=0.0), dict()),
+    ("medium", dict(n_items=12, n_discounts=2, taxes=("GST",)), dict(noise=0.01, skew=1.0)),
+    ("large", dict(n_items=40, n_discounts=6, taxes=("SST", "GST")), dict(noise=0.03, skew=2.5)),
+]
+
+
+def measure(fn, min_time: float = 0.5, min_iters: int = 20, max_iters: int = 100_000) -> dict:
+    """Call fn repeatedly and return throughput and latency percentiles (microseconds)."""
+    fn()  # warm-up
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_iters and (len(samples) < min_iters or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    pct = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6
+    return {
+        "iterations": len(samples),
+        "ops_per_sec": round(len(samples) / sum(samples), 1),
+        "p50_us": round(pct(0.50), 2),
+        "p95_us": round(pct(0.95), 2),
+        "p99_us": round(pct(0.99), 2),
+        "mean_us": round(statistics.fmean(samples) * 1e6, 2),
+    }
+
+
+def _canned_llm(receipt):
+    return mock.patch.object(ai_parser, "call_openrouter", lambda prompt, **kwargs: receipt["llm_response"])
+
+
+def bench_scenario(label, gen_kwargs, render_kwargs, ocr_mode, min_time) -> dict:
+    receipt = generate_receipt(seed=42, **gen_kwargs)
+    cleaned = clean_ocr_text(receipt["text"])
+    participants = ["Alice", "Bob", "Carol", "Dave"]
+    results = {}
+
+    results["clean_ocr_text"] = measure(lambda: clean_ocr_text(receipt["text"]), min_time)
+    llm_items = json.loads(receipt["llm_response"])["items"]
+    results["detect_item_discounts"] = measure(
+        lambda: ai_parser.detect_item_discounts(cleaned, copy.deepcopy(llm_items)), min_time)
+
+    with _canned_llm(receipt):
+        parsed = ai_parser.parse_receipt_text(cleaned, participants)
+        results["parse_postprocess"] = measure(lambda: ai_parser.parse_receipt_text(cleaned, participants), min_time)
+    results["parse_postprocess"]["total_matches_truth"] = abs(parsed["computed_total"] - receipt["computed_total"]) < 0.011
+
+    assigned = copy.deepcopy(parsed)
+    for k, it in enumerate(assigned["items"]):
+        it["assigned_to"] = [participants[k % len(participants)]]
+    results["compute_splits_even"] = measure(lambda: compute_splits(parsed, participants), min_time)
+    results["compute_splits_item"] = measure(lambda: compute_splits(assigned, participants, mode="item"), min_time)
+
+    buf = io.BytesIO()
+    render_receipt(receipt, **render_kwargs).convert("RGB").save(buf, format="JPEG", quality=90)
+    image_bytes = buf.getvalue()
+    client = app_module.app.test_client()
+
+    # the fake backend cannot be picked per request; make it the process default instead
+    env = {"OCR_BACKEND": "fake", "OCR_ENABLE_FAKE": "1"} if ocr_mode == "stub" else {"OCR_BACKEND": "tesseract"}
+
+    def post():
+        resp = client.post("/process", data={
+            "image": (io.BytesIO(image_bytes), f"bench_{label}.jpg"),
+            "participants": json.dumps(participants),
+        }, content_type="multipart/form-data")
+        assert resp.status_code == 200, resp.data
+
+    with _canned_llm(receipt), mock.patch.dict(os.environ, env):
+        if ocr_mode == "stub":
+            ocr.get_backend("fake").text = receipt["text"]
+        results["process_endpoint"] = measure(post, min_time, min_iters=5)
+    results["process_endpoint"]["ocr"] = ocr_mode
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return human-readable regressions where p50 latency grew by more than `threshold`."""
+    regressions = []
+    for scenario, benches in results.items():
+        for name, stats in benches.items():
+            base = baseline.get(scenario, {}).get(name)
+            if not base or base.get("ocr", stats.get("ocr")) != stats.get("ocr"):
+                continue
+            if stats["p50_us"] > base["p50_us"] * (1 + threshold):
+                regressions.append(f"{scenario}/{name}: p50 {base['p50_us']}us -> {stats['p50_us']}us "
+                                   f"(+{(stats['p50_us'] / base['p50_us'] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--save", action="store_true", help="write results as the new baseline")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--threshold", type=float, default=0.25, help="allowed p50 slowdown (0.25 = 25%%)")
+    ap.add_argument("--ocr", choices=["auto", "real", "stub"], default="auto")
+    ap.add_argument("--min-time", type=float, default=0.5, help="seconds spent per benchmark")
+    ap.add_argument("--only", help="comma-separated scenario labels to run")
+    args = ap.parse_args(argv)
+
+    ocr_mode = args.ocr
+    if ocr_mode == "auto":
+        ocr_mode = "real" if shutil.which("tesseract") else "stub"
+
+    selected = set(args.only.split(",")) if args.only else None
+    results = {}
+    for label, gen_kwargs, render_kwargs in SCENARIOS:
+        if selected and label not in selected:
+            continue
+        results[label] = bench_scenario(label, gen_kwargs, render_kwargs, ocr_mode, args.min_time)
+        for name, stats in results[label].items():
+            print(f"{label:>6} {name:<22} {stats['ops_per_sec']:>12.1f} ops/s  "
+                  f"p50 {stats['p50_us']:>10.1f}us  p99 {stats['p99_us']:>10.1f}us")
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline found; run with --save to create one")
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    regressions = compare(results, baseline, args.threshold)
+    for r in regressions:
+        print(f"REGRESSION {r}")
+    mismatches = [s for s, b in results.items() if not b["parse_postprocess"]["total_matches_truth"]]
+    for s in mismatches:
+        print(f"ACCURACY {s}: computed_total differs from ground truth")
+    return 1 if regressions or mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+# currency.py
+import os, re, json, time, threading
+
+# ISO code -> (display symbol, aliases recognised in OCR text). Aliases are matched
+# case-insensitively; alphabetic ones only as whole words (so "RM" never matches "FIRM").
+CURRENCIES = {
+    "USD": ("$", ["US$", "USD"]),
+    "SGD": ("S$", ["S$", "SGD"]),
+    "MYR": ("RM", ["RM", "MYR"]),
+    "EUR": ("€", ["€", "EUR"]),
+    "GBP": ("£", ["£", "GBP"]),
+    "JPY": ("¥", ["¥", "JPY", "円"]),
+    "AUD": ("A$", ["A$", "AUD"]),
+    "HKD": ("HK$", ["HK$", "HKD"]),
+    "IDR": ("Rp", ["RP", "IDR"]),
+    "THB": ("฿", ["฿", "THB"]),
+    "INR": ("₹", ["₹", "INR"]),
+    "PHP": ("₱", ["₱", "PHP"]),
+    "KRW": ("₩", ["₩", "KRW"]),
+    "CNY": ("CN¥", ["CN¥", "RMB", "CNY"]),
+}
+
+# Written without minor units, so "25.000" is twenty-five thousand
+NO_MINOR_UNITS = {"JPY", "KRW", "IDR"}
+
+# A bare "$" is ambiguous; most receipts this bot sees are USD unless configured otherwise
+DOLLAR_CURRENCY = os.getenv("DOLLAR_CURRENCY", "USD")
+DEFAULT_CURRENCY = os.getenv("DEFAULT_CURRENCY", DOLLAR_CURRENCY)
+
+_DASHES = str.maketrans({"−": "-", "—": "-", "–": "-"})
+
+
+_ALIASES = {a.upper(): code for code, (_, names) in CURRENCIES.items() for a in names}
+_ALIASES["$"] = DOLLAR_CURRENCY
+# currencies written with a "$" ("S$", "HK$"); a bare "$" on the same receipt means the same one
+_DOLLAR_CODES = {code for alias, code in _ALIASES.items() if "$" in alias and alias != "$"}
+
+
+def _build_trie(aliases) -> dict:
+    trie = {}
+    for alias in aliases:
+        node = trie
+        for ch in alias:
+            node = node.setdefault(ch, {})
+        node[""] = True
+    return trie
+
+
+def _trie_pattern(node: dict) -> str:
+    """Compile a trie into an equivalent regex; longer continuations are tried first."""
+    branches = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    return f"(?:{body})?" if "" in node else body
+
+
+# Symbol aliases ("$", "€") may touch letters or digits on either side; ones that start with a
+# letter ("S$", "HK$") need a word start so "FRIES$4.00" is not read as S$; word aliases
+# ("RM", "EUR") only match standalone. Compiled once at import so every scan runs inside the
+# regex engine; the leading lookahead lets the engine skip positions that cannot start an alias.
+_SYMBOL_TRIE = _build_trie(a for a in _ALIASES if not a[0].isalpha())
+_PREFIXED_TRIE = _build_trie(a for a in _ALIASES if a[0].isalpha() and not a.isalpha())
+_WORD_TRIE = _build_trie(a for a in _ALIASES if a.isalpha())
+_FIRST_CHARS = "".join(re.escape(c) for c in sorted({a[0] for a in _ALIASES}))
+_PATTERN = (f"(?=[{_FIRST_CHARS}])(?:{_trie_pattern(_SYMBOL_TRIE)}"
+            f"|(?<![^\\W\\d_]){_trie_pattern(_PREFIXED_TRIE)}"
+            f"|(?<![^\\W\\d_]){_trie_pattern(_WORD_TRIE)}(?![^\\W\\d_]))")
+_CURRENCY_RE = re.compile(_PATTERN)           # for upper-cased text (detection)
+_CURRENCY_RE_I = re.compile(_PATTERN, re.I)   # for original text (stripping)
+
+
+def detect_currency(text: str, bare_dollar: bool = True):
+    """
+    Most frequent currency mentioned in text as an ISO code, or None.
+    A bare "$" counts toward the dollar currency named elsewhere in the text ("S$", "HKD"),
+    otherwise toward DOLLAR_CURRENCY, or not at all with bare_dollar=False.
+    """
+    counts = {}
+    bare = 0
+    for alias in _CURRENCY_RE.findall((text or "").upper()):
+        if alias == "$":
+            bare += 1
+            continue
+        code = _ALIASES[alias]
+        counts[code] = counts.get(code, 0) + 1
+    if bare:
+        dollars = [c for c in counts if c in _DOLLAR_CODES]
+        target = max(dollars, key=counts.get) if dollars else (DOLLAR_CURRENCY if bare_dollar else None)
+        if target:
+            counts[target] = counts.get(target, 0) + bare
+    return max(counts, key=counts.get) if counts else None
+
+
+def normalize_code(value) -> str:
+    """Map an LLM/OCR currency label ("RM", "S$", "eur") to an ISO code, or None."""
+    if not value:
+        return None
+    value = str(value).strip()
+    if value.upper() in CURRENCIES:
+        return value.upper()
+    return detect_currency(value)
+
+
+def strip_symbols(s: str) -> str:
+    """Remove every currency symbol/code from s (amounts and signs are left in place)."""
+    return _CURRENCY_RE_I.sub("", s)
+
+
+# thousands groups may also be separated by a space, NBSP or narrow NBSP ("1 234,50")
+_NUMBER_RE = re.compile(r"(-)?\s*(\d{1,3}(?:[ \u00a0\u202f]\d{3})+(?:[.,]\d{1,2})?(?!\d)|\d(?:[\d.,']*\d)?)")
+_GROUP_SEPARATORS = str.maketrans("", "", " \u00a0\u202f'")
+_DOT_GROUPS_RE = re.compile(r"\d{1,3}(?:\.\d{3})+")
+
+
+def parse_amount(s, decimal: str = None, currency: str = None) -> float:
+    """
+    Parse a money string such as "RM 1.234,50", "-$2.00", "S$1,234.56" or "1 234,50".
+    decimal forces the decimal separator ("." or ","); otherwise it is inferred from the string.
+    currency (else detected from s) only matters for "25.000", which is 25000 in a currency
+    without minor units.
+    """
+    m = _NUMBER_RE.search(strip_symbols(str(s).translate(_DASHES)))
+    if not m:
+        return 0.0
+    num = m.group(2).translate(_GROUP_SEPARATORS)
+    if decimal is None:
+        if "," in num and "." in num:
+            decimal = "," if num.rfind(",") > num.rfind(".") else "."
+        elif "," in num:
+            decimal = "," if num.count(",") == 1 and len(num) - num.rfind(",") <= 3 else "."
+        elif num.count(".") == 1 and _DOT_GROUPS_RE.fullmatch(num):
+            decimal = "," if (currency or detect_currency(str(s))) in NO_MINOR_UNITS else "."
+        else:
+            decimal = "." if num.count(".") <= 1 else ","
+    thousands = "," if decimal == "." else "."
+    num = num.replace(thousands, "").replace(decimal, ".")
+    value = float(num)
+    return -value if m.group(1) else value
+
+
+# In whole receipts only NBSP/narrow NBSP count as group separators: a plain space
+# ("1 234,50") may just as well separate a quantity from a price.
+_COMMA_DECIMAL_RE = re.compile(r"(?<![\d.,])(\d{1,3}(?:[.\u00a0\u202f]\d{3})+|\d+),(\d{2})(?![\d,])")
+_DOT_DECIMAL_RE = re.compile(r"(?<![\d.,])(\d{1,3}(?:[,\u00a0\u202f]\d{3})+|\d+)\.(\d{2})(?![\d.])")
+_SPACE_GROUPS = str.maketrans("", "", "\u00a0\u202f")
+_DOT_THOUSANDS_RE = re.compile(r"(?<![\d.,])\d{1,3}(?:\.\d{3})+(?![\d.,])")
+
+
+def detect_decimal_separator(text: str) -> str:
+    """"," if the receipt writes amounts like 12,50 / 1.234,50, else "."."""
+    return "," if len(_COMMA_DECIMAL_RE.findall(text)) > len(_DOT_DECIMAL_RE.findall(text)) else "."
+
+
+def normalize_amounts(text: str, currency: str = None):
+    """
+    Rewrite every amount in a receipt to plain dot-decimal form (1.234,50 -> 1234.50,
+    1,234.50 -> 1234.50) so downstream parsing never has to guess per number.
+    currency: the receipt's ISO code if known; for JPY/KRW/IDR 25.000 becomes 25000.
+    Returns (normalized_text, detected_decimal_separator).
+    """
+    no_minor = currency in NO_MINOR_UNITS
+    if "," not in text and not no_minor:
+        return text, "."
+    decimal = detect_decimal_separator(text) if "," in text else "."
+    if decimal == ",":
+        text = _COMMA_DECIMAL_RE.sub(
+            lambda m: f"{m.group(1).replace('.', '').translate(_SPACE_GROUPS)}.{m.group(2)}", text)
+        text = _DOT_THOUSANDS_RE.sub(lambda m: m.group(0).replace(".", ""), text)
+        return text, decimal
+    if "," in text:
+        text = _DOT_DECIMAL_RE.sub(
+            lambda m: f"{m.group(1).replace(',', '').translate(_SPACE_GROUPS)}.{m.group(2)}", text)
+    if no_minor:
+        text = _DOT_THOUSANDS_RE.sub(lambda m: m.group(0).replace(".", ""), text)
+    return text, decimal
+
+
+def format_amount(amount: float, code: str = None) -> str:
+    code = code or DEFAULT_CURRENCY
+    symbol = CURRENCIES.get(code, (f"{code} ",))[0]
+    return f"{'-' if amount < 0 else ''}{symbol}{abs(amount):.2f}"
+
+
+class RateTable:
+    """
+    File-backed exchange-rate table ({"base": "USD", "rates": {"SGD": 1.35, ...}}, meaning
+    1 base = rate units). Lookups are served from memory; the file is re-read only when
+    its mtime changes, checked at most every `reload_interval` seconds. Nothing here
+    touches the network; refresh() is the only call that does.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 60.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.base = DEFAULT_CURRENCY
+        self.rates = {}
+        self.updated = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self._checked and now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            with open(self.path) as fh:
+                data = json.load(fh)
+            self.base = data.get("base", self.base).upper()
+            self.rates = {k.upper(): float(v) for k, v in (data.get("rates") or {}).items()}
+            self.rates[self.base] = 1.0
+            self.updated = data.get("updated")
+            self._mtime = mtime
+
+    def rate(self, from_code: str, to_code: str) -> float:
+        """Units of to_code per one unit of from_code."""
+        if from_code == to_code:
+            return 1.0
+        self._maybe_reload()
+        try:
+            return self.rates[to_code] / self.rates[from_code]
+        except KeyError as e:
+            raise ValueError(f"no exchange rate for {e.args[0]} in {self.path}") from None
+
+    def set_rates(self, rates: dict, base: str = None):
+        with self._lock:
+            self.base = (base or self.base).upper()
+            self.rates = {k.upper(): float(v) for k, v in rates.items()}
+            self.rates[self.base] = 1.0
+            self.updated = int(time.time())
+        self.save()
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"base": self.base, "updated": self.updated, "rates": self.rates}, fh, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+        with self._lock:
+            self._mtime = os.path.getmtime(self.path)
+            self._checked = time.monotonic()
+
+    def refresh(self, url: str = None):
+        """Fetch {"base": ..., "rates": {...}} from FX_RATES_URL and cache it to disk."""
+        import requests
+        resp = requests.get(url or os.environ["FX_RATES_URL"], timeout=10)
+        resp.raise_for_status()
+        data = resp.json()
+        self.set_rates(data["rates"], data.get("base"))
+
+
+_default_rates = None
+
+
+def default_rates() -> RateTable:
+    global _default_rates
+    if _default_rates is None:
+        _default_rates = RateTable(os.getenv("FX_RATES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fx_rates.json")))
+    return _default_rates
@@ -0,0 +1,282 @@
+# loadtest.py
+"""
+Load-test harness for tg_bot.
+
+Simulates N Telegram users walking the full ConversationHandler flow
+(start -> photo -> split mode -> names -> confirm -> item selection) against an
+in-process fake Bot API, with OCR and OpenRouter replaced by stubs of configurable
+latency. Nothing leaves the machine.
+
+    python loadtest.py --users 50 --llm-latency 0.8 --ocr-latency 0.3
+    python loadtest.py --users 200 --concurrent-updates 64 --mode own --json
+
+Reports conversations/sec, per-handler p50/p99 (time from the update entering the
+bot until its handler returns, including queueing) and event-loop lag.
+"""
+import argparse, asyncio, io, itertools, json, os, statistics, sys, tempfile, time
+from contextlib import contextmanager
+from unittest import mock
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+import ai_parser
+import tg_bot
+from receipt_gen import generate_receipt, render_receipt
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "SplitterBot", "username": "splitter_bot"}
+
+
+class FakeBotAPI(BaseRequest):
+    """
+    Minimal in-memory Bot API. Answers the methods tg_bot uses, records every message the
+    bot sends per chat and serves a fixed receipt image for file downloads.
+    """
+
+    def __init__(self, photo_bytes: bytes, latency: float = 0.0):
+        self.photo_bytes = photo_bytes
+        self.latency = latency
+        self.messages = {}  # chat_id -> list of message dicts sent by the bot
+        self.calls = {}
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, text, reply_markup=None, message_id=None):
+        msg = {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+        markup = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+        if markup and "inline_keyboard" in markup:  # Telegram only echoes inline keyboards back
+            msg["reply_markup"] = markup
+        return msg
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if "/file/bot" in url:
+            return 200, self.photo_bytes
+
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+
+        if endpoint == "getMe":
+            result = dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                          supports_inline_queries=False)
+        elif endpoint == "sendMessage":
+            result = self._message(params["chat_id"], params["text"], params.get("reply_markup"))
+            self.messages.setdefault(int(params["chat_id"]), []).append(result)
+        elif endpoint == "editMessageText":
+            result = self._message(params["chat_id"], params["text"], message_id=params["message_id"])
+        elif endpoint == "answerCallbackQuery":
+            result = True
+        elif endpoint == "getFile":
+            result = {"file_id": params["file_id"], "file_unique_id": "receipt",
+                      "file_size": len(self.photo_bytes), "file_path": "photos/receipt.jpg"}
+        else:
+            return 400, json.dumps({"ok": False, "error_code": 400,
+                                    "description": f"fake api: unsupported method {endpoint}"}).encode()
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def last_message(self, chat_id) -> dict:
+        return self.messages[chat_id][-1]
+
+
+class SimulatedUser:
+    def __init__(self, uid: int, bot, processor, process_update, api: FakeBotAPI, latencies: dict,
+                 mode: str, n_people: int, think: float):
+        self.uid = uid
+        self.user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        self.chat = {"id": uid, "type": "private"}
+        self.bot, self.processor, self.process_update = bot, processor, process_update
+        self.api, self.latencies = api, latencies
+        self.mode, self.n_people, self.think = mode, n_people, think
+        self._ids = itertools.count(1)
+
+    async def _send(self, handler: str, payload: dict):
+        update = Update.de_json(dict(payload, update_id=self.uid * 100_000 + next(self._ids)), self.bot)
+        start = time.perf_counter()
+        await self.processor.process_update(update, self.process_update(update))
+        self.latencies.setdefault(handler, []).append(time.perf_counter() - start)
+        if self.think:
+            await asyncio.sleep(self.think)
+
+    def _message(self, **fields) -> dict:
+        return {"message": dict(message_id=next(self._ids), date=int(time.time()),
+                                chat=self.chat, **{"from": self.user}, **fields)}
+
+    def _callback(self, data: str) -> dict:
+        return {"callback_query": {"id": f"{self.uid}-{next(self._ids)}", "from": self.user,
+                                   "chat_instance": str(self.uid), "data": data,
+                                   "message": self.api.last_message(self.uid)}}
+
+    def _buttons(self) -> list:
+        markup = self.api.last_message(self.uid).get("reply_markup") or {}
+        return [b["callback_data"] for row in markup.get("inline_keyboard", []) for b in row]
+
+    async def run(self):
+        await self._send("handle_receipt_start", self._message(text="🚀 Start Receipt Splitter"))
+        await self._send("handle_receipt", self._message(photo=[
+            {"file_id": f"photo{self.uid}", "file_unique_id": f"u{self.uid}", "width": 600, "height": 900}]))
+        await self._send("ask_names", self._message(text="Even Split" if self.mode == "even" else "Each Pays Their Own"))
+        await self._send("confirm_people", self._message(text=" ".join(f"P{i}" for i in range(self.n_people))))
+        await self._send("confirm_people_response", self._callback("yes"))
+        if self.mode == "even":
+            return
+        # each person takes the first remaining item, then presses Done
+        for _ in range(self.n_people):
+            selectable = [d for d in self._buttons() if d.startswith("select|")]
+            if selectable:
+                await self._send("handle_selection", self._callback(selectable[0]))
+            if "done" not in self._buttons():
+                break
+            await self._send("handle_selection", self._callback("done"))
+
+
+async def monitor_loop_lag(samples: list, interval: float, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+
+@contextmanager
+def _scratch_cwd():
+    # the bot downloads receipts to a relative path; keep those writes out of the repo
+    prev = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield
+        finally:
+            os.chdir(prev)
+
+
+def _pct(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_load(users: int = 20, mode: str = "even", people: int = 3, llm_latency: float = 0.5,
+                   ocr_latency: float = 0.2, api_latency: float = 0.0, concurrent_updates: int = 1,
+                   ramp: float = 0.0, think: float = 0.0, lag_interval: float = 0.01) -> dict:
+    receipt = generate_receipt(n_items=max(people, 6), n_discounts=1, seed=1)
+    buf = io.BytesIO()
+    render_receipt(receipt).convert("RGB").save(buf, format="JPEG")
+    api = FakeBotAPI(buf.getvalue(), latency=api_latency)
+
+    # OCR and OpenRouter are synchronous in the bot, so the stubs block just like the real calls
+    def fake_ocr(path):
+        time.sleep(ocr_latency)
+        return receipt["text"]
+
+    def fake_llm(prompt, **kwargs):
+        time.sleep(llm_latency)
+        return receipt["llm_response"]
+
+    application = (ApplicationBuilder().token("123456:LOADTEST").request(api).get_updates_request(api)
+                   .concurrent_updates(concurrent_updates).build())
+    application.add_handler(tg_bot.build_conversation())
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(on_error)
+
+    latencies, lag = {}, []
+    stop = asyncio.Event()
+    with mock.patch.object(tg_bot, "extract_text_from_image", fake_ocr), \
+            mock.patch.object(ai_parser, "call_openrouter", fake_llm), _scratch_cwd():
+        await application.initialize()
+        monitor = asyncio.create_task(monitor_loop_lag(lag, lag_interval, stop))
+        sims = [SimulatedUser(10_000 + i, application.bot, application.update_processor,
+                              application.process_update, api, latencies, mode, people, think)
+                for i in range(users)]
+
+        async def start(i, sim):
+            if ramp:
+                await asyncio.sleep(ramp * i / users)
+            await sim.run()
+
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(start(i, s) for i, s in enumerate(sims)), return_exceptions=True)
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await monitor
+        await application.shutdown()
+
+    failed = [r for r in results if isinstance(r, BaseException)]
+    return {
+        "users": users,
+        "mode": mode,
+        "concurrent_updates": concurrent_updates,
+        "elapsed_s": round(elapsed, 3),
+        "conversations_per_sec": round((users - len(failed)) / elapsed, 2),
+        "failed_conversations": len(failed),
+        "handler_errors": len(errors),
+        "error_samples": sorted(set(errors + [repr(r) for r in failed]))[:5],
+        "handlers": {
+            name: {"count": len(v), "p50_ms": round(_pct(v, 0.5) * 1e3, 2), "p99_ms": round(_pct(v, 0.99) * 1e3, 2)}
+            for name, v in latencies.items()
+        },
+        "loop_lag_ms": {
+            "p50": round(_pct(lag, 0.5) * 1e3, 2),
+            "p99": round(_pct(lag, 0.99) * 1e3, 2),
+            "max": round(max(lag, default=0.0) * 1e3, 2),
+            "mean": round(statistics.fmean(lag) * 1e3, 2) if lag else 0.0,
+        },
+        "api_calls": api.calls,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--mode", choices=["even", "own"], default="even")
+    ap.add_argument("--people", type=int, default=3, help="participants per conversation")
+    ap.add_argument("--llm-latency", type=float, default=0.5, help="seconds per stubbed OpenRouter call")
+    ap.add_argument("--ocr-latency", type=float, default=0.2, help="seconds per stubbed OCR call")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    ap.add_argument("--concurrent-updates", type=int, default=1,
+                    help="Application.concurrent_updates (tg_bot runs with 1, the PTB default)")
+    ap.add_argument("--ramp", type=float, default=0.0, help="spread user start times over this many seconds")
+    ap.add_argument("--think", type=float, default=0.0, help="user pause between steps in seconds")
+    ap.add_argument("--json", action="store_true", help="print the raw JSON report")
+    args = ap.parse_args(argv)
+
+    report = asyncio.run(run_load(args.users, args.mode, args.people, args.llm_latency, args.ocr_latency,
+                                  args.api_latency, args.concurrent_updates, args.ramp, args.think))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(f"{report['users']} users, mode={report['mode']}, concurrent_updates={report['concurrent_updates']}")
+    print(f"  {report['conversations_per_sec']} conversations/s over {report['elapsed_s']}s "
+          f"({report['failed_conversations']} failed, {report['handler_errors']} handler errors)")
+    for err in report["error_samples"]:
+        print(f"  error: {err}")
+    for name, h in report["handlers"].items():
+        print(f"  {name:<24} n={h['count']:<6} p50 {h['p50_ms']:>9.2f}ms  p99 {h['p99_ms']:>9.2f}ms")
+    lag = report["loop_lag_ms"]
+    print(f"  event-loop lag           p50 {lag['p50']:>9.2f}ms  p99 {lag['p99']:>9.2f}ms  max {lag['max']:.2f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,279 @@
 # ocr.py
-import os
-from PIL import Image
-import pytesseract
+import os, logging, threading, queue, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import timed, OCR_BATCH_SIZE
 
-# Check if Google Vision is enabled via environment variable
-USE_GOOGLE = os.getenv('USE_GOOGLE_VISION', '0') == '1'
+log = logging.getLogger(__name__)
 
-if USE_GOOGLE:
-    from google.cloud import vision
+# --- Backend registry ---
+# Backends import their OCR libraries lazily and are created once per process, so
+# importing this module stays cheap and clients (e.g. the Vision gRPC channel) are reused.
+_BACKENDS = {}
+_instances = {}
+_instances_lock = threading.Lock()
+# name -> (monotonic time, error) of the last failed construction; retried after OCR_RETRY_SECONDS
+_failures = {}
+
+
+class BackendUnavailable(RuntimeError):
+    """A known OCR backend could not be created here (library missing, no credentials, ...)."""
+
+
+def register_backend(name: str, local_only: bool = False):
+    # local_only backends (test doubles) are never selectable per request and
+    # refuse to load unless OCR_ENABLE_FAKE=1
+    def decorator(cls):
+        cls.name = name
+        cls.local_only = local_only
+        _BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def available_backends() -> list:
+    """Backends a client may pick per request."""
+    return sorted(name for name, cls in _BACKENDS.items() if not cls.local_only)
+
+
+def _enabled(name: str) -> bool:
+    return name in _BACKENDS and (not _BACKENDS[name].local_only or os.getenv('OCR_ENABLE_FAKE', '0') == '1')
+
+
+def default_backend_name() -> str:
+    # OCR_BACKEND wins; USE_GOOGLE_VISION=1 is kept for existing deployments
+    if os.getenv('OCR_BACKEND'):
+        return os.getenv('OCR_BACKEND')
+    return 'google' if os.getenv('USE_GOOGLE_VISION', '0') == '1' else 'tesseract'
+
+
+def get_backend(name: str = None):
+    """Return the shared instance of backend `name` (default from the environment), creating it once."""
+    name = name or default_backend_name()
+    if not _enabled(name):
+        raise ValueError(f"unknown OCR backend {name!r}; available: {', '.join(available_backends())}")
+    backend = _instances.get(name)
+    if backend is not None:
+        return backend
+    with _instances_lock:
+        if name in _instances:
+            return _instances[name]
+        failed_at, error = _failures.get(name, (None, None))
+        if failed_at is not None and time.monotonic() - failed_at < float(os.getenv('OCR_RETRY_SECONDS', 60)):
+            raise BackendUnavailable(f"OCR backend {name!r} is unavailable: {error}")
+        try:
+            _instances[name] = _BACKENDS[name]()
+        except Exception as e:
+            log.warning("OCR backend %s could not be created: %s", name, e)
+            _failures[name] = (time.monotonic(), f"{type(e).__name__}: {e}")
+            raise BackendUnavailable(f"OCR backend {name!r} is unavailable: {_failures[name][1]}") from e
+        _failures.pop(name, None)
+        return _instances[name]
+
+
+def warm_up(name: str = None):
+    """Create and warm up a backend ahead of the first receipt (call at process start)."""
+    backend = get_backend(name)
+    with timed("ocr_warm_up"):
+        backend.warm_up()
+    return backend
+
+
+def backend_health() -> dict:
+    """Health of every backend created (or that failed to be created) so far in this process."""
+    health = {name: {"ok": False, "error": error} for name, (_, error) in list(_failures.items())}
+    health.update({name: backend.health() for name, backend in list(_instances.items())})
+    return health
+
+
+class OCRBackend:
+    name = None
+    local_only = False
+
+    def extract_raw(self, path: str) -> str:
+        raise NotImplementedError
+
+    def extract_raw_many(self, paths: list) -> list:
+        return [self.extract_raw(p) for p in paths]
+
+    def warm_up(self):
+        pass
+
+    def health(self) -> dict:
+        return {"ok": True}
+
+
+@register_backend('tesseract')
+class TesseractBackend(OCRBackend):
+    # line-based mode with better spacing
+    config = "--psm 6 -c preserve_interword_spaces=1"
+
+    def __init__(self):
+        from PIL import Image
+        import pytesseract
+        self._image = Image
+        self._pytesseract = pytesseract
+
+    def extract_raw(self, path: str) -> str:
+        with timed("preprocess"):
+            img = self._image.open(path).convert('RGB')
+        with timed("ocr"):
+            return self._pytesseract.image_to_string(img, config=self.config)
+
+    def warm_up(self):
+        self._pytesseract.get_tesseract_version()
+
+    def health(self) -> dict:
+        try:
+            return {"ok": True, "version": str(self._pytesseract.get_tesseract_version())}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+
+class _VisionBatcher:
+    """
+    Coalesces concurrent Vision requests into batch_annotate_images calls.
+    The first queued image opens a window of `window` seconds; everything that arrives
+    before it closes (up to `max_batch` images) goes out in one RPC, and each caller
+    gets its own result back through a Future.
+    """
+
+    def __init__(self, client, feature_type, window: float, max_batch: int, max_in_flight: int = 4):
+        self.client = client
+        self.feature_type = feature_type
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='vision-batch')
+        self._collector = None
+        self._collector_lock = threading.Lock()
+
+    def submit(self, content: bytes) -> Future:
+        if self._collector is None:
+            with self._collector_lock:
+                if self._collector is None:
+                    self._collector = threading.Thread(target=self._collect, name='vision-batcher', daemon=True)
+                    self._collector.start()
+        fut = Future()
+        self._queue.put((content, fut))
+        return fut
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list):
+        OCR_BATCH_SIZE.observe(len(batch))
+        requests = [{"image": {"content": content}, "features": [{"type_": self.feature_type}]}
+                    for content, _ in batch]
+        try:
+            responses = list(self.client.batch_annotate_images(requests=requests).responses)
+            if len(responses) != len(batch):
+                raise RuntimeError(f"Google Vision returned {len(responses)} responses for {len(batch)} images")
+            for (_, fut), res in zip(batch, responses):
+                if res.error.message:
+                    fut.set_exception(RuntimeError(f"Google Vision error: {res.error.message}"))
+                else:
+                    fut.set_result(res.text_annotations[0].description if res.text_annotations else '')
+        except Exception as e:
+            # never leave a caller waiting on a Future nobody will resolve
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+@register_backend('google')
+class GoogleVisionBackend(OCRBackend):
+    """
+    Vision OCR over one shared client. Concurrent requests are micro-batched
+    (VISION_BATCH_WINDOW_MS, VISION_MAX_BATCH); a window of 0 sends one
+    text_detection RPC per image instead. Batched callers give up after
+    VISION_TIMEOUT seconds.
+    """
+
+    def __init__(self, client=None, batch_window_ms: float = None, max_batch: int = None, timeout: float = None):
+        from google.cloud import vision
+        self._vision = vision
+        self.client = client or vision.ImageAnnotatorClient()
+        if batch_window_ms is None:
+            batch_window_ms = float(os.getenv('VISION_BATCH_WINDOW_MS', 10))
+        if max_batch is None:
+            max_batch = int(os.getenv('VISION_MAX_BATCH', 16))  # Vision's per-request image limit
+        self.timeout = timeout if timeout is not None else float(os.getenv('VISION_TIMEOUT', 30))
+        self._batcher = None
+        if batch_window_ms > 0 and max_batch > 1:
+            self._batcher = _VisionBatcher(self.client, vision.Feature.Type.TEXT_DETECTION,
+                                           batch_window_ms / 1000.0, max_batch)
+
+    def _read(self, path: str) -> bytes:
+        with timed("preprocess"):
+            with open(path, 'rb') as img:
+                return img.read()
+
+    def extract_raw(self, path: str) -> str:
+        content = self._read(path)
+        with timed("ocr"):
+            if self._batcher is not None:
+                return self._batcher.submit(content).result(timeout=self.timeout)
+            response = self.client.text_detection(image=self._vision.Image(content=content))
+        if response.error.message:
+            raise RuntimeError(f"Google Vision error: {response.error.message}")
+        texts = response.text_annotations
+        return texts[0].description if texts else ''
+
+    def extract_raw_many(self, paths: list) -> list:
+        if self._batcher is None:
+            return super().extract_raw_many(paths)
+        futures = [self._batcher.submit(self._read(p)) for p in paths]
+        with timed("ocr"):
+            deadline = time.monotonic() + self.timeout
+            return [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+
+    def warm_up(self):
+        # open the gRPC channel now instead of on the first receipt
+        channel = getattr(self.client.transport, 'grpc_channel', None)
+        if channel is not None:
+            import grpc
+            grpc.channel_ready_future(channel).result(timeout=10)
+
+    def health(self) -> dict:
+        channel = getattr(self.client.transport, 'grpc_channel', None)
+        if channel is None:
+            return {"ok": True}
+        import grpc
+        try:
+            grpc.channel_ready_future(channel).result(timeout=1)
+            return {"ok": True}
+        except grpc.FutureTimeoutError:
+            return {"ok": False, "error": "channel not ready"}
+
+
+@register_backend('fake', local_only=True)
+class FakeBackend(OCRBackend):
+    """
+    Local backend for tests and benchmarks: returns the contents of a `<image>.txt`
+    sidecar file if present, else `text` (FAKE_OCR_TEXT by default).
+    Only loads with OCR_ENABLE_FAKE=1 and only as the process default (OCR_BACKEND=fake).
+    """
+
+    def __init__(self, text: str = None):
+        self.text = text if text is not None else os.getenv('FAKE_OCR_TEXT', '')
+
+    def extract_raw(self, path: str) -> str:
+        sidecar = os.path.splitext(path)[0] + '.txt'
+        if os.path.exists(sidecar):
+            with open(sidecar) as fh:
+                return fh.read()
+        return self.text
 
 
 def clean_ocr_text(text):
@@ -46,39 +312,25 @@ def clean_ocr_text(text):
     return text.strip()
 
 
-def extract_text_from_image(path: str) -> str:
+def extract_text_from_image(path: str, backend: str = None) -> str:
     """
-    Extracts text from a receipt image using either Google Vision or Tesseract,
-    then cleans it to improve number and price accuracy.
+    Extracts text from a receipt image with the named OCR backend (default from
+    OCR_BACKEND / USE_GOOGLE_VISION), then cleans it to improve number and price accuracy.
     """
-    if USE_GOOGLE:
-        # Google Cloud Vision OCR
-        from google.cloud import vision
-        client = vision.ImageAnnotatorClient()
-        with open(path, 'rb') as img:
-            content = img.read()
-        image = vision.Image(content=content)
-        response = client.text_detection(image=image)
-        texts = response.text_annotations
-        if texts:
-            raw_text = texts[0].description
-        else:
-            raw_text = ''
-    else:
-        # pytesseract fallback (use line-based mode with better spacing)
-        img = Image.open(path).convert('RGB')
-        raw_text = pytesseract.image_to_string(
-            img,
-            config="--psm 6 -c preserve_interword_spaces=1"
-        )
+    raw_text = get_backend(backend).extract_raw(path)
 
     # Clean the OCR text before returning
-    cleaned_text = clean_ocr_text(raw_text)
+    with timed("clean"):
+        cleaned_text = clean_ocr_text(raw_text)
 
-    print("\n--- RAW OCR TEXT ---")
-    print(raw_text[:500])
-    print("\n--- CLEANED OCR TEXT ---")
-    print(cleaned_text[:500])
-    print("------------------------\n")
+    log.debug("raw OCR text: %.500s", raw_text)
+    log.debug("cleaned OCR text: %.500s", cleaned_text)
 
     return cleaned_text
+
+
+def extract_texts_from_images(paths: list, backend: str = None) -> list:
+    """Batch variant of extract_text_from_image (one cleaned text per path, same order)."""
+    raw_texts = get_backend(backend).extract_raw_many(paths)
+    with timed("clean"):
+        return [clean_ocr_text(t) for t in raw_texts]
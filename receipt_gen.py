@@ -0,0 +1,108 @@
+# receipt_gen.py
+import json, random
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+MENU = [
+    "AGLIO OLIO", "CARBONARA", "MARGHERITA PIZZA", "CAESAR SALAD", "ICED LEMON TEA",
+    "MUSHROOM SOUP", "FISH N CHIPS", "BEEF BURGER", "GARLIC BREAD", "TIRAMISU",
+    "LATTE", "NASI LEMAK", "CHICKEN WINGS", "FRIES", "MINERAL WATER", "PAD THAI",
+]
+DISCOUNT_LABELS = ["Xmas Special", "Discount", "Promo", "Member Rebate"]
+
+
+def _money(x: float) -> str:
+    return f"${x:.2f}"
+
+
+def generate_receipt(n_items: int = 8, n_discounts: int = 1, taxes=("GST",), tax_rate: float = 0.06,
+                     service_pct: float = 10.0, seed: int = 0) -> dict:
+    """
+    Build a synthetic receipt and its ground truth.
+    Returns {"lines", "text", "items", "discounts", "taxes", "service_charge",
+             "computed_total", "llm_response"} where llm_response is the JSON a well-behaved
+    model would return for this receipt (used as a canned stub for call_openrouter).
+    """
+    rng = random.Random(seed)
+    names = rng.sample(MENU, min(n_items, len(MENU)))
+    while len(names) < n_items:
+        names.append(f"{rng.choice(MENU)} {len(names)}")
+
+    items = []
+    for name in names:
+        qty = rng.choice([1, 1, 1, 2, 3])
+        unit = round(rng.uniform(2.5, 35.0), 2)
+        items.append({"name": name, "qty": qty, "unit_price": unit, "total_price": round(unit * qty, 2)})
+
+    discounted = rng.sample(range(len(items)), min(n_discounts, len(items)))
+    discounts = []
+    for k in sorted(discounted):
+        amount = round(min(items[k]["total_price"] / 2, rng.uniform(1.0, 5.0)), 2)
+        discounts.append({"description": rng.choice(DISCOUNT_LABELS), "amount": amount, "item": items[k]["name"]})
+
+    lines = ["THE SYNTHETIC BISTRO", "TABLE 12  PAX 4", ""]
+    by_item = {d["item"]: d for d in discounts}
+    for it in items:
+        lines.append(f"{it['qty']} {it['name']} {_money(it['total_price'])}")
+        d = by_item.get(it["name"])
+        if d:
+            lines.append(f"{d['description']} -{_money(d['amount'])}")
+
+    subtotal = round(sum(it["total_price"] for it in items) - sum(d["amount"] for d in discounts), 2)
+    service_amt = round(subtotal * service_pct / 100, 2) if service_pct else 0.0
+    tax_list = [{"type": t, "amount": round((subtotal + service_amt) * tax_rate, 2)} for t in taxes]
+
+    lines.append("")
+    lines.append(f"Subtotal {_money(subtotal)}")
+    if service_amt:
+        lines.append(f"Service Charge {service_pct:g}% {_money(service_amt)}")
+    for t in tax_list:
+        lines.append(f"{t['type']} {tax_rate * 100:g}% {_money(t['amount'])}")
+    total = round(subtotal + service_amt + sum(t["amount"] for t in tax_list), 2)
+    lines.append(f"Total {_money(total)}")
+
+    service_charge = {"percent": service_pct, "amount": service_amt} if service_amt else None
+    llm_response = json.dumps({
+        "items": items,
+        "taxes": tax_list,
+        "service_charge": service_charge,
+        "discounts": discounts,
+        "currency": "USD",
+    })
+    return {
+        "lines": lines,
+        "text": "\n".join(lines),
+        "items": items,
+        "discounts": discounts,
+        "taxes": tax_list,
+        "service_charge": service_charge,
+        "computed_total": total,
+        "llm_response": llm_response,
+    }
+
+
+def render_receipt(receipt: dict, noise: float = 0.0, skew: float = 0.0, seed: int = 0,
+                   font_size: int = 18) -> Image.Image:
+    """
+    Render receipt lines to a grayscale image.
+    noise: fraction of pixels flipped to random grey (0..1); skew: rotation in degrees.
+    """
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:  # Pillow < 10.1 has a single bitmap font
+        font = ImageFont.load_default()
+    line_h = font_size + 8
+    width = 32 * font_size
+    img = Image.new("L", (width, line_h * (len(receipt["lines"]) + 2)), 255)
+    draw = ImageDraw.Draw(img)
+    for i, line in enumerate(receipt["lines"]):
+        draw.text((font_size, line_h * (i + 1)), line, fill=0, font=font)
+
+    if noise:
+        rng = random.Random(seed)
+        px = img.load()
+        for _ in range(int(img.width * img.height * noise)):
+            px[rng.randrange(img.width), rng.randrange(img.height)] = rng.randrange(256)
+        img = img.filter(ImageFilter.GaussianBlur(0.4))
+    if skew:
+        img = img.rotate(skew, expand=True, fillcolor=255, resample=Image.BICUBIC)
+    return img
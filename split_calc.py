@@ -1,28 +1,36 @@
+
 from decimal import Decimal, ROUND_HALF_UP
 
-def compute_splits(parsed: dict, participants: list, mode="even") -> dict:
-    """
-    Compute per-person splits.
-    mode: "even" or "item" (per-assignment)
-    """
-    n = max(1, len(participants))
-    names = participants if participants else [f"P{i+1}" for i in range(n)]
-    
+CENT = Decimal("0.01")
+
+
+def _receipt_total(parsed: dict) -> Decimal:
+    total = parsed.get("computed_total")
+    if total is None:
+        # receipts that never went through the parser: derive total from line items
+        total = sum(it.get("total_price", 0) for it in parsed.get("items", []))
+        total += sum(t.get("amount", 0) for t in parsed.get("taxes", []))
+        total += (parsed.get("service_charge") or {}).get("amount") or 0
+    return Decimal(str(total or 0.0))
+
+
+def _receipt_shares(parsed: dict, names: list, mode: str) -> dict:
+    """Unrounded per-person Decimal shares of one receipt, in the receipt's own currency."""
+    n = len(names)
+
     if mode == "even":
-        total = Decimal(str(parsed.get("computed_total") or 0.0))
-        share = (total / n).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        per_person = {p: float(share) for p in names}
-        return per_person
+        return dict.fromkeys(names, _receipt_total(parsed) / n)
 
     # --- item-assignment mode ---
     items = parsed.get("items", [])
     taxes = Decimal(str(sum(t.get("amount", 0) for t in parsed.get("taxes", []))))
-    service = Decimal(str(parsed.get("service_charge", {}).get("amount") or 0))
-    discounts = Decimal(str(sum(d.get("amount", 0) for d in parsed.get("discounts", []))))
+    service = Decimal(str((parsed.get("service_charge") or {}).get("amount") or 0))
+    # discounts the parser applied are already taken out of their item's total_price
+    discounts = Decimal(str(sum(d.get("amount", 0) for d in parsed.get("discounts", []) if not d.get("applied"))))
 
     subtotal_by_person = {p: Decimal("0") for p in names}
     subtotal_total = Decimal("0")
-    
+
     for it in items:
         total_price = Decimal(str(it.get("total_price", 0)))
         assigned = it.get("assigned_to")
@@ -38,14 +46,47 @@ def compute_splits(parsed: dict, participants: list, mode="even") -> dict:
         subtotal_total += total_price
 
     per_person = subtotal_by_person.copy()
-    
+
     def apply_amount(amount):
         for p in names:
-            proportion = (subtotal_by_person[p] / subtotal_total) if subtotal_total else 1/n
+            proportion = (subtotal_by_person[p] / subtotal_total) if subtotal_total else Decimal(1) / n
             per_person[p] += Decimal(amount) * proportion
 
     apply_amount(taxes + service - discounts)
+    return per_person
+
+
+def compute_splits(parsed, participants: list, mode="even", base_currency=None, rates=None) -> dict:
+    """
+    Compute per-person splits.
+    parsed: one parsed receipt, or a list of them (a trip) settled together.
+    mode: "even" or "item" (per-assignment)
+    base_currency: settle in this ISO code; receipts in other currencies are converted
+        once per receipt (not per item) using `rates` (a currency.RateTable, default table
+        if omitted). Without it a trip is settled in the currency of its first receipt.
+    """
+    n = max(1, len(participants))
+    names = participants if participants else [f"P{i+1}" for i in range(n)]
+    if not isinstance(parsed, list) and (base_currency is None or parsed.get("currency") in (None, base_currency)):
+        # single receipt, no conversion (the common case); even mode rounds the one share once
+        if mode == "even":
+            return dict.fromkeys(names, float((_receipt_total(parsed) / n).quantize(CENT, rounding=ROUND_HALF_UP)))
+        shares = _receipt_shares(parsed, names, mode)
+        return {p: float(shares[p].quantize(CENT, rounding=ROUND_HALF_UP)) for p in names}
+
+    receipts = parsed if isinstance(parsed, list) else [parsed]
+    currencies = [r.get("currency") for r in receipts]
+    base = base_currency or next((c for c in currencies if c), None)
+    if rates is None and any(c and c != base for c in currencies):
+        from currency import default_rates
+        rates = default_rates()
+
+    totals = {p: Decimal("0") for p in names}
+    for receipt, code in zip(receipts, currencies):
+        shares = _receipt_shares(receipt, names, mode)
+        factor = Decimal(str(rates.rate(code, base))) if code and base and code != base else None
+        for p in names:
+            totals[p] += shares[p] * factor if factor is not None else shares[p]
 
     # Round final totals
-    final_totals = {p: float(per_person[p].quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)) for p in names}
-    return final_totals
+    return {p: float(totals[p].quantize(CENT, rounding=ROUND_HALF_UP)) for p in names}
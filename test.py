@@ -1,7 +1,327 @@
 # test.py
+import pytest
 from split_calc import compute_splits
 
 def test_equal_split():
     parsed = {'items': [{'name': 'Total', 'total_price': 90}], 'taxes': [], 'service_charge': None, 'discounts': []}
     splits = compute_splits(parsed, ['A','B','C'])
-    assert round(splits['A'],2) == 30.00
\ No newline at end of file
+    assert round(splits['A'],2) == 30.00
+
+def test_split_endpoint_reuses_stored_receipt():
+    from app import app, store_receipt
+    parsed = {
+        'items': [{'name': 'Pasta', 'qty': 1, 'total_price': 20}, {'name': 'Pizza', 'qty': 1, 'total_price': 10}],
+        'taxes': [{'type': 'GST', 'amount': 3}], 'service_charge': None, 'discounts': [], 'computed_total': 33,
+    }
+    receipt_id = store_receipt(parsed)
+    client = app.test_client()
+
+    resp = client.post(f'/receipts/{receipt_id}/split', json={'participants': ['A', 'B'], 'mode': 'even'})
+    assert resp.get_json()['splits'] == {'A': 16.5, 'B': 16.5}
+
+    resp = client.post(f'/receipts/{receipt_id}/split',
+                       json={'participants': ['A', 'B'], 'assignments': {'A': [0], 'B': [1]}, 'mode': 'item'})
+    assert resp.get_json()['splits'] == {'A': 22.0, 'B': 11.0}
+    assert 'assigned_to' not in parsed['items'][0]
+
+    assert client.post('/receipts/missing/split', json={}).status_code == 404
+
+
+def test_metrics_endpoint_reports_stage_latency():
+    from app import app, store_receipt
+    from metrics import STAGE_SECONDS
+    receipt_id = store_receipt({'items': [{'name': 'Tea', 'total_price': 4}], 'taxes': [], 'discounts': []})
+    before = STAGE_SECONDS.count(stage='split')
+    client = app.test_client()
+    client.post(f'/receipts/{receipt_id}/split', json={'participants': ['A', 'B']})
+    assert STAGE_SECONDS.count(stage='split') == before + 1
+
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE receipt_stage_duration_seconds histogram' in body
+    assert 'receipt_stage_total{stage="split",status="ok"}' in body
+
+
+def test_synthetic_receipt_parses_to_ground_truth(monkeypatch):
+    import ai_parser
+    from ocr import clean_ocr_text
+    from receipt_gen import generate_receipt
+    receipt = generate_receipt(n_items=10, n_discounts=3, taxes=('SST', 'GST'), seed=7)
+    monkeypatch.setattr(ai_parser, 'call_openrouter', lambda prompt, **kwargs: receipt['llm_response'])
+    parsed = ai_parser.parse_receipt_text(clean_ocr_text(receipt['text']))
+    assert parsed['computed_total'] == receipt['computed_total']
+
+
+def test_item_mode_does_not_reapply_item_discounts(monkeypatch):
+    import ai_parser
+    from ocr import clean_ocr_text
+    from receipt_gen import generate_receipt
+    receipt = generate_receipt(n_items=5, n_discounts=2, seed=3)
+    monkeypatch.setattr(ai_parser, 'call_openrouter', lambda prompt, **kwargs: receipt['llm_response'])
+    parsed = ai_parser.parse_receipt_text(clean_ocr_text(receipt['text']))
+    even = compute_splits(parsed, ['A', 'B'], mode='even')
+    item = compute_splits(parsed, ['A', 'B'], mode='item')
+    assert round(sum(item.values()), 2) == round(sum(even.values()), 2) == receipt['computed_total']
+
+    # a discount the model ties to an item but the OCR lines never show is still taken off
+    import json
+    llm = json.dumps({'items': [{'name': 'BURGER', 'qty': 1, 'total_price': 8.0},
+                                {'name': 'FRIES', 'qty': 1, 'total_price': 2.0}],
+                      'discounts': [{'description': 'Promo', 'amount': 3, 'item': 'FRIES'}]})
+    monkeypatch.setattr(ai_parser, 'call_openrouter', lambda prompt, **kwargs: llm)
+    parsed = ai_parser.parse_receipt_text('1 BURGER $8.00\n1 FRIES $2.00')
+    assert [it['total_price'] for it in parsed['items']] == [8.0, 2.0]
+    assert sum(compute_splits(parsed, ['A', 'B'], mode='item').values()) == 7.0
+    assert sum(compute_splits(parsed, ['A', 'B'], mode='even').values()) == 7.0
+
+
+def test_bot_conversation_flow_under_load():
+    import asyncio
+    from loadtest import run_load
+    report = asyncio.run(run_load(users=3, mode='own', people=2, llm_latency=0, ocr_latency=0))
+    assert report['failed_conversations'] == 0 and report['handler_errors'] == 0
+    assert report['handlers']['handle_selection']['count'] == 3 * 2 * 2
+
+
+def test_process_selects_ocr_backend_per_request(monkeypatch):
+    import io
+    import app as app_module
+    import ocr
+    monkeypatch.delenv('OCR_ENABLE_FAKE', raising=False)
+    with pytest.raises(ValueError):
+        ocr.get_backend('fake')
+    monkeypatch.setenv('OCR_ENABLE_FAKE', '1')
+    monkeypatch.setenv('OCR_BACKEND', 'fake')
+    fake = ocr.get_backend('fake')
+    assert ocr.get_backend('fake') is fake
+    monkeypatch.setattr(fake, 'text', '1 LATTE $6.00\n1 BAGEL $4.00')
+    monkeypatch.setattr(app_module, 'parse_receipt_text',
+                        lambda text, participants: {'items': [], 'taxes': [], 'discounts': [], 'computed_total': 10.0})
+    client = app_module.app.test_client()
+
+    resp = client.post('/process', data={'image': (io.BytesIO(b'jpeg'), 'r.jpg')}, content_type='multipart/form-data')
+    assert resp.get_json()['ocr_text'] == '1 LATTE $6.00\n1 BAGEL $4.00'
+
+    # clients may only pick real backends
+    for name in ('fake', 'nope'):
+        resp = client.post('/process', data={'image': (io.BytesIO(b'jpeg'), 'r.jpg'), 'ocr_backend': name},
+                           content_type='multipart/form-data')
+        assert resp.status_code == 400
+
+    used = []
+    monkeypatch.setattr(app_module, 'extract_text_from_image', lambda path, backend: used.append(backend) or '')
+    client.post('/process', data={'image': (io.BytesIO(b'jpeg'), 'r.jpg'), 'ocr_backend': 'google'},
+                content_type='multipart/form-data')
+    assert used == ['google']
+
+
+def test_unavailable_ocr_backend_returns_503(monkeypatch):
+    import io
+    import app as app_module
+    import ocr
+    attempts = []
+
+    class NoCredentials(ocr.OCRBackend):
+        def __init__(self):
+            attempts.append(1)
+            raise RuntimeError('could not find default credentials')
+
+    monkeypatch.setitem(ocr._BACKENDS, 'google', NoCredentials)
+    monkeypatch.setattr(ocr, '_instances', {})
+    monkeypatch.setattr(ocr, '_failures', {})
+    client = app_module.app.test_client()
+    for _ in range(2):
+        resp = client.post('/process', data={'image': (io.BytesIO(b'jpeg'), 'r.jpg'), 'ocr_backend': 'google'},
+                           content_type='multipart/form-data')
+        assert resp.status_code == 503 and 'credentials' in resp.get_json()['error']
+    assert len(attempts) == 1  # the failure is remembered instead of rebuilding the client per request
+    assert client.get('/health/ocr').status_code == 503
+
+
+def test_vision_backend_coalesces_concurrent_requests(tmp_path):
+    import threading
+    from types import SimpleNamespace
+    from ocr import GoogleVisionBackend
+
+    class FakeVisionClient:
+        def __init__(self):
+            self.batch_sizes = []
+
+        def batch_annotate_images(self, requests):
+            self.batch_sizes.append(len(requests))
+            return SimpleNamespace(responses=[
+                SimpleNamespace(error=SimpleNamespace(message=''),
+                                text_annotations=[SimpleNamespace(description=r['image']['content'].decode())])
+                for r in requests
+            ])
+
+    paths = []
+    for i in range(6):
+        p = tmp_path / f'r{i}.jpg'
+        p.write_bytes(f'receipt {i}'.encode())
+        paths.append(str(p))
+
+    client = FakeVisionClient()
+    backend = GoogleVisionBackend(client=client, batch_window_ms=200, max_batch=4)
+    results = {}
+    threads = [threading.Thread(target=lambda p=p: results.__setitem__(p, backend.extract_raw(p))) for p in paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(client.batch_sizes) == [2, 4]
+    assert all(results[p] == f'receipt {i}' for i, p in enumerate(paths))
+    assert backend.extract_raw_many(paths[:3]) == ['receipt 0', 'receipt 1', 'receipt 2']
+
+    # a short batch response fails every caller instead of leaving some blocked forever
+    client.batch_annotate_images = lambda requests: SimpleNamespace(responses=[])
+    backend = GoogleVisionBackend(client=client, batch_window_ms=50, max_batch=4, timeout=5)
+    with pytest.raises(RuntimeError, match='0 responses for 3 images'):
+        backend.extract_raw_many(paths[:3])
+
+
+def test_model_router_race_fallback_and_small_receipts(monkeypatch):
+    import json, time
+    import ai_parser
+    valid = json.dumps({'items': [{'name': 'Tea', 'qty': 1, 'total_price': 3.0}]})
+    calls, cancelled = [], []
+
+    def fake_openrouter(prompt, model=None, cancel_event=None):
+        calls.append(model)
+        if model == 'broken':
+            raise Exception('OpenRouter API error 503')
+        if model == 'garbage':
+            return 'sorry, I cannot read this receipt'
+        if model == 'slow':
+            if cancel_event is not None and cancel_event.wait(2):
+                cancelled.append(model)
+                raise ai_parser.LLMCancelled(model)
+            time.sleep(0.05)
+        return valid
+
+    monkeypatch.setattr(ai_parser, 'call_openrouter', fake_openrouter)
+
+    router = ai_parser.ModelRouter(['broken', 'garbage', 'fast'])
+    assert router.complete('prompt') == valid
+    assert calls == ['broken', 'garbage', 'fast']
+    assert router.ranked(['broken', 'garbage', 'fast'])[0] == 'fast'
+
+    calls.clear()
+    router = ai_parser.ModelRouter(['slow', 'fast', 'broken'], strategy='race')
+    assert router.complete('prompt') == valid
+    deadline = time.time() + 1
+    while not cancelled and time.time() < deadline:  # loser notices cancellation on its own thread
+        time.sleep(0.01)
+    assert sorted(calls) == ['fast', 'slow'] and cancelled == ['slow']
+
+    calls.clear()
+    router = ai_parser.ModelRouter(['fast'], small_model='cheap', small_lines=2)
+    router.complete('prompt', ocr_text='1 TEA $3.00')
+    router.complete('prompt', ocr_text='1 TEA $3.00\n1 BUN $2.00\n1 PIE $4.00')
+    assert calls == ['cheap', 'fast']
+
+
+def test_race_learns_from_cancelled_losers(monkeypatch):
+    import json, threading, time
+    import ai_parser
+    valid = json.dumps({'items': [{'name': 'Tea', 'qty': 1, 'total_price': 3.0}]})
+    latency = {'slow': 0.5, 'fast': 0.02, 'medium': 0.08}
+    races, finished = [], threading.Semaphore(0)
+
+    def fake_openrouter(prompt, model=None, cancel_event=None):
+        races[-1].add(model)
+        try:
+            if cancel_event.wait(latency[model]):
+                raise ai_parser.LLMCancelled(model)
+            return valid
+        finally:
+            finished.release()
+
+    monkeypatch.setattr(ai_parser, 'call_openrouter', fake_openrouter)
+    router = ai_parser.ModelRouter(['slow', 'fast', 'medium'], strategy='race')
+    for _ in range(5):
+        races.append(set())
+        assert router.complete('prompt') == valid
+        for _ in races[-1]:  # let the loser record its cancellation before the next receipt
+            assert finished.acquire(timeout=2)
+
+    # every model is tried once, then the measured winner always races and the
+    # models only known to be slower take turns instead of one of them every time
+    assert races[:2] == [{'slow', 'fast'}, {'fast', 'medium'}]
+    assert all('fast' in r for r in races)
+    assert sorted([sum('slow' in r for r in races), sum('medium' in r for r in races)]) == [2, 3]
+    assert router.stats()['slow']['ewma'] >= router.stats()['fast']['ewma']
+
+
+def test_cancelled_llm_call_is_not_an_error(monkeypatch):
+    import threading
+    from types import SimpleNamespace
+    import ai_parser
+    from metrics import STAGE_SECONDS, STAGE_TOTAL
+    cancel = threading.Event()
+
+    def lines(decode_unicode=True):
+        yield 'data: {"choices": [{"delta": {"content": "{"}}]}'
+        cancel.set()  # another model won the race
+        yield 'data: {"choices": [{"delta": {"content": "}"}}]}'
+
+    resp = SimpleNamespace(status_code=200, iter_lines=lines, close=lambda: None)
+    monkeypatch.setattr(ai_parser.requests, 'post', lambda *args, **kwargs: resp)
+    errors, observed = STAGE_TOTAL.value(stage='llm', status='error'), STAGE_SECONDS.count(stage='llm')
+    with pytest.raises(ai_parser.LLMCancelled):
+        ai_parser.call_openrouter('prompt', model='slow', cancel_event=cancel)
+    assert STAGE_TOTAL.value(stage='llm', status='cancelled') >= 1
+    assert STAGE_TOTAL.value(stage='llm', status='error') == errors
+    assert STAGE_SECONDS.count(stage='llm') == observed
+
+
+def test_currency_detection_and_locale_amounts():
+    from currency import detect_currency, normalize_amounts, parse_amount
+    assert detect_currency('NASI LEMAK RM 12,50\nTOTAL RM 25,00 FIRM') == 'MYR'
+    assert detect_currency('Total S$18.40') == 'SGD'
+    # OCR that drops spaces must not turn FRIES$ into S$ or PIZZA$ into A$
+    assert detect_currency('2 FRIES$4.00\n1 PIZZA$12.00\nTOTAL $16.00') == 'USD'
+    # bare "$" lines belong to the dollar the receipt names elsewhere
+    assert detect_currency('1 LAKSA $8.00\n1 KOPI $2.00\nSUBTOTAL $10.00\nGST $0.90\nTOTAL S$10.90') == 'SGD'
+    assert parse_amount('RM 1.234,50') == 1234.5
+    assert parse_amount('-S$1,234.56') == -1234.56
+    text, decimal = normalize_amounts('1 PASTA 12,50\n1 STEAK 1.234,00\nTotal 1.246,50')
+    assert decimal == ',' and text == '1 PASTA 12.50\n1 STEAK 1234.00\nTotal 1246.50'
+    # space / NBSP / narrow NBSP thousands, and currencies without minor units
+    assert parse_amount('1 234,50') == parse_amount('1\u00a0234,50') == parse_amount('1\u202f234.50') == 1234.5
+    assert parse_amount('Rp 25.000') == 25000 and parse_amount('25.000', currency='KRW') == 25000
+    assert parse_amount('25.000') == 25.0
+    assert normalize_amounts('NASI GORENG Rp 25.000\nTOTAL Rp 1.250.000', 'IDR')[0] == \
+        'NASI GORENG Rp 25000\nTOTAL Rp 1250000'
+    assert normalize_amounts('1 STEAK 1\u00a0234,50\nTOTAL 1\u00a0246,50')[0] == '1 STEAK 1234.50\nTOTAL 1246.50'
+
+
+def test_model_currency_beats_bare_dollar(monkeypatch):
+    import json
+    import ai_parser
+    llm = json.dumps({'items': [{'name': 'LAKSA', 'qty': 1, 'total_price': 8.0}], 'currency': 'SGD'})
+    monkeypatch.setattr(ai_parser, 'call_openrouter', lambda prompt, **kwargs: llm)
+    assert ai_parser.parse_receipt_text('1 LAKSA $8.00\nTOTAL $8.00')['currency'] == 'SGD'
+    llm = json.dumps({'items': [{'name': 'LAKSA', 'qty': 1, 'total_price': 8.0}]})
+    assert ai_parser.parse_receipt_text('1 LAKSA $8.00\nTOTAL $8.00')['currency'] == ai_parser.DOLLAR_CURRENCY
+
+
+def test_mixed_currency_trip_settles_in_base_currency(tmp_path):
+    from currency import RateTable
+    rates = RateTable(str(tmp_path / 'fx_rates.json'))
+    rates.set_rates({'SGD': 1.25, 'MYR': 4.0}, base='USD')
+    sgd = {'items': [], 'taxes': [], 'computed_total': 50.0, 'currency': 'SGD'}
+    myr = {'items': [], 'taxes': [], 'computed_total': 80.0, 'currency': 'MYR'}
+
+    splits = compute_splits([sgd, myr], ['A', 'B'], base_currency='SGD', rates=rates)
+    assert splits == {'A': 37.5, 'B': 37.5}  # 50 SGD + 80 MYR (= 25 SGD), halved
+    assert RateTable(rates.path).rate('MYR', 'USD') == 0.25
+
+    from app import app, store_receipt
+    receipt_id = store_receipt(sgd)
+    client = app.test_client()
+    for label in ('sgd', 'S$'):
+        resp = client.post(f'/receipts/{receipt_id}/split', json={'participants': ['A', 'B'], 'base_currency': label})
+        assert resp.status_code == 200 and resp.get_json()['currency'] == 'SGD'
+    resp = client.post(f'/receipts/{receipt_id}/split', json={'participants': ['A'], 'base_currency': 'doubloons'})
+    assert resp.status_code == 400
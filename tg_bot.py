@@ -1,15 +1,21 @@
 # tg_bot.py
-import os
+import os, logging
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     ApplicationBuilder, ConversationHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 )
+import ocr
 from ocr import extract_text_from_image
 from ai_parser import parse_receipt_text
+from metrics import timed, start_metrics_server
+from currency import format_amount
 
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+log = logging.getLogger(__name__)
 
 # --- Conversation States ---
 WAIT_RECEIPT, ASK_SPLIT_MODE, ASK_NAMES, CONFIRM_PEOPLE, ITEM_SELECTION = range(5)
@@ -52,9 +58,10 @@ async def handle_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    photo = await update.message.photo[-1].get_file()
     img_path = "temp_receipt.jpg"
-    await photo.download_to_drive(img_path)
+    with timed("download"):
+        photo = await update.message.photo[-1].get_file()
+        await photo.download_to_drive(img_path)
 
     context.user_data["receipt_path"] = img_path
     await update.message.reply_text(
@@ -119,18 +126,20 @@ async def confirm_people_response(update: Update, context: ContextTypes.DEFAULT_
 
     # --- EVEN SPLIT MODE ---
     if split_mode == "even":
-        # Use total from receipt
-        total = parsed.get("total") or parsed.get("computed_total") or 0.0
-        if not total:
-            total = sum(item.get("total_price", 0) for item in parsed.get("items", []))
-            total += sum(t.get("amount", 0) for t in parsed.get("taxes", []))
-            total += parsed.get("service_charge", {}).get("amount") or 0
-            total -= sum(d.get("amount", 0) for d in parsed.get("discounts", []))
-
-        share = round(total / max(1, len(participants)), 2)
-        result = {p: share for p in participants}
-
-        msg = "*Even Split:*\n" + "\n".join(f"{p}: ${amt:.2f}" for p, amt in result.items())
+        with timed("split"):
+            # Use total from receipt
+            total = parsed.get("total") or parsed.get("computed_total") or 0.0
+            if not total:
+                total = sum(item.get("total_price", 0) for item in parsed.get("items", []))
+                total += sum(t.get("amount", 0) for t in parsed.get("taxes", []))
+                total += parsed.get("service_charge", {}).get("amount") or 0
+                total -= sum(d.get("amount", 0) for d in parsed.get("discounts", []) if not d.get("applied"))
+
+            share = round(total / max(1, len(participants)), 2)
+            result = {p: share for p in participants}
+
+        currency = parsed.get("currency")
+        msg = "*Even Split:*\n" + "\n".join(f"{p}: {format_amount(amt, currency)}" for p, amt in result.items())
         await query.message.reply_text(msg, parse_mode="Markdown")
         return ConversationHandler.END
 
@@ -172,7 +181,7 @@ async def ask_next_person(update_or_query, context: ContextTypes.DEFAULT_TYPE):
 
     # Inline buttons for selecting items
     buttons = [
-        [InlineKeyboardButton(f"{name} (${price:.2f})", callback_data=f"select|{idx}|{seq}")]
+        [InlineKeyboardButton(f"{name} ({format_amount(price, parsed.get('currency'))})", callback_data=f"select|{idx}|{seq}")]
         for idx, seq, name, price in unit_list
     ]
     buttons.append([InlineKeyboardButton("✅ Done", callback_data="done")])
@@ -216,34 +225,34 @@ async def finalize_split(update, context: ContextTypes.DEFAULT_TYPE):
     parsed = context.chat_data["parsed"]
     participants = context.user_data["participants"]
 
-    subtotal = sum(item["total_price"] for item in parsed["items"])
-    tax_amount = sum(t.get("amount", 0) for t in parsed.get("taxes", []))
-    service_amount = (parsed.get("service_charge", {}) or {}).get("amount") or 0
-    subtotal = subtotal or 1
+    with timed("split"):
+        subtotal = sum(item["total_price"] for item in parsed["items"])
+        tax_amount = sum(t.get("amount", 0) for t in parsed.get("taxes", []))
+        service_amount = (parsed.get("service_charge", {}) or {}).get("amount") or 0
+        subtotal = subtotal or 1
 
-    tax_rate = tax_amount / subtotal
-    service_rate = service_amount / subtotal
+        tax_rate = tax_amount / subtotal
+        service_rate = service_amount / subtotal
 
-    per_person = {p: 0 for p in participants}
-    for item in parsed["items"]:
-        if "assigned_to" not in item or not item["assigned_to"]:
-            continue
-        cost_share = item["total_price"] / len(item["assigned_to"])
-        for person in item["assigned_to"]:
-            per_person[person] += cost_share
+        per_person = {p: 0 for p in participants}
+        for item in parsed["items"]:
+            if "assigned_to" not in item or not item["assigned_to"]:
+                continue
+            cost_share = item["total_price"] / len(item["assigned_to"])
+            for person in item["assigned_to"]:
+                per_person[person] += cost_share
 
-    for p in per_person:
-        per_person[p] *= (1 + tax_rate + service_rate)
+        for p in per_person:
+            per_person[p] *= (1 + tax_rate + service_rate)
 
-    msg = "*Final Split:*\n" + "\n".join(f"{p}: ${amt:.2f}" for p, amt in per_person.items())
+    currency = parsed.get("currency")
+    msg = "*Final Split:*\n" + "\n".join(f"{p}: {format_amount(amt, currency)}" for p, amt in per_person.items())
     await update.reply_text(msg, parse_mode="Markdown")
 
 
 # --- Main entry ---
-def main():
-    application = ApplicationBuilder().token(TOKEN).build()
-
-    conv = ConversationHandler(
+def build_conversation() -> ConversationHandler:
+    return ConversationHandler(
         entry_points=[
             MessageHandler(filters.TEXT & filters.Regex("^🚀 Start Receipt Splitter$"), handle_receipt_start),
             MessageHandler(filters.TEXT & filters.Regex("^🔄 Restart$"), handle_restart),
@@ -259,8 +268,18 @@ def main():
         fallbacks=[],
     )
 
-    application.add_handler(conv)
-    print("Bot started (polling)...")
+
+def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+        log.info("Serving Prometheus metrics on :%s/metrics", METRICS_PORT)
+
+    ocr.warm_up()
+    application = ApplicationBuilder().token(TOKEN).build()
+    application.add_handler(build_conversation())
+    log.info("Bot started (polling)...")
     application.run_polling()
 
 
@@ -1,6 +1,7 @@
 # utils.py
-import re
+from currency import detect_currency
+
 
 def find_currency(text: str):
-    m = re.search(r"(USD|SGD|MYR|RM|\$|€|EUR)", text, re.I)
-    return m.group(0) if m else None
\ No newline at end of file
+    """ISO code of the currency used in text (e.g. "MYR" for "RM 12.50"), or None."""
+    return detect_currency(text)